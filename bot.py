@@ -1,12 +1,23 @@
 import os
+import re
+import io
+import shutil
+import tempfile
+import time
+import asyncio
+import threading
 import logging
-import telebot
-import pytubefix as pytube
+import contextlib
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 import zipfile
-import json
-from telebot import types
+from telebot import types, asyncio_filters
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import State, StatesGroup
+from telebot.asyncio_storage import StateMemoryStorage
+from telebot.asyncio_helper import ApiTelegramException
 from pytubefix import YouTube, Playlist
-from moviepy import VideoFileClip
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 from user_manager import UserContactManager
@@ -15,8 +26,60 @@ load_dotenv()
 
 # Configuration
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+# Long-polling hold time for getUpdates (Telegram accepts up to 50s)
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 20))
+# Largest file a bot may upload through the Bot API
+TELEGRAM_MAX_UPLOAD = 50 * 1024 ** 2
+# Header bytes of a stored zip entry besides its name, with room to spare
+ZIP_ENTRY_OVERHEAD = 128
+# Worker threads for blocking downloads and file I/O
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 32))
+# Conversation sessions and states are dropped after SESSION_TTL seconds
+SESSION_MAX = 10_000
+SESSION_TTL = 600
+# Simultaneous downloads per playlist or retry run, sent in paced batches
+DOWNLOAD_CONCURRENCY = 2
+BATCH_SIZE = 100
+BATCH_PAUSE = 0.1  # seconds between batches
+# Local cache of downloaded videos, evicted least recently used first
+CACHE_DIR = 'cache'
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 5 * 1024 ** 3))
+CACHE_TMP_PREFIX = '.tmp-'
+CACHE_TMP_MAX_AGE = 3600  # seconds before an unfinished temp entry counts as abandoned
+# Each entry holds the media under a fixed name plus the name shown to the user
+CACHE_MEDIA_FILE = 'media'
+CACHE_NAME_FILE = 'name'
 
-user_data = {}
+# YouTube video/playlist links and the playlist marker inside them
+_YT_RE = re.compile(r'(?:https?://)?(?:www\.|m\.)?(?:youtube\.com/(?:watch\?|playlist\?|shorts/)|youtu\.be/)[^\s]+', re.IGNORECASE)
+_PLAYLIST_RE = re.compile(r'[?&]list=')
+
+@dataclass(slots=True)
+class Session:
+    """
+    Per-chat conversation state between sending a URL and picking a format
+    """
+    url: str
+    is_playlist: bool
+    format_choice: str | None = None
+
+class FileTooLargeError(Exception):
+    """
+    Download that Telegram would refuse; retrying cannot help
+    """
+    def __init__(self, size):
+        super().__init__(
+            f"o arquivo tem {size / 1024 ** 2:.0f} MB e o Telegram aceita até "
+            f"{TELEGRAM_MAX_UPLOAD // 1024 ** 2} MB"
+        )
+
+class DownloadStates(StatesGroup):
+    """
+    Conversation states replacing the next-step handler chain
+    """
+    format_selection = State()
+    retry_selection = State()
+    specific_retry = State()
 
 class YouTubeDownloader:
     def __init__(self, bot_token):
@@ -25,13 +88,24 @@ class YouTubeDownloader:
         
         :param bot_token: Telegram Bot Token
         """
-        self.bot = telebot.TeleBot(bot_token)
+        state_storage = StateMemoryStorage()
+        # Expire abandoned conversation states together with their sessions
+        state_storage.data = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)
+        self.bot = AsyncTeleBot(bot_token, state_storage=state_storage)
+        self.bot.add_custom_filter(asyncio_filters.StateFilter(self.bot))
         self.contact_manager = UserContactManager()
-        self.failed_downloads = {}  # Track failed download attempts
+        # Hot cache of failed downloads stored in the database, keyed by chat ID
+        self.failed_downloads: dict[int, list[tuple[str, str]]] = {}
+        self._yt_cache = TTLCache(maxsize=256, ttl=300)  # Resolved YouTube objects by URL
+        self.sessions = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)  # Session by chat ID
+        self._inflight = {}  # Downloads in progress by (url, format)
+        self._shared_jobs = {}  # Playlist jobs in progress by (url, format), see _shared
+        self._background_tasks = set()  # Fire-and-forget tasks kept alive until done
+        self._evict_lock = threading.Lock()  # Only one cache eviction pass at a time
         self.setup_handlers()
         
         # Ensure necessary directories exist
-        for dir in ['downloads', 'playlist_zip', 'failed_lists']:
+        for dir in ['downloads', CACHE_DIR]:
             os.makedirs(dir, exist_ok=True)
         
     def setup_handlers(self):
@@ -39,7 +113,7 @@ class YouTubeDownloader:
         Setup bot message handlers with enhanced error management
         """
         @self.bot.message_handler(commands=['start'])
-        def send_welcome(message):
+        async def send_welcome(message):
             welcome_text = (
                 "Bem-vindo ao YouTube Downloader Bot! 🎥\n\n"
                 "Comandos disponíveis:\n"
@@ -48,18 +122,19 @@ class YouTubeDownloader:
                 "/help - Mostrar ajuda"
             )
             self.contact_manager.save_user_contact(message.from_user)
-            self.bot.reply_to(message, welcome_text)
+            await self.bot.reply_to(message, welcome_text)
         
         @self.bot.message_handler(commands=['retry'])
-        def handle_retry(message):
+        async def handle_retry(message):
             """
             Handle retry of failed downloads
             """
             chat_id = message.chat.id
             
             # Check if there are failed downloads for this user
-            if str(chat_id) not in self.failed_downloads or not self.failed_downloads[str(chat_id)]:
-                self.bot.send_message(chat_id, "Não há downloads com falha para tentar novamente.")
+            failed_list = self.get_failed_list(chat_id)
+            if not failed_list:
+                await self.bot.send_message(chat_id, "Não há downloads com falha para tentar novamente.")
                 return
             
             # Create retry markup
@@ -71,41 +146,58 @@ class YouTubeDownloader:
             
             # Send retry options
             retry_msg = "Escolha uma opção de retry:"
-            failed_list = self.failed_downloads[str(chat_id)]
             retry_msg += "\n\nVídeos com falha:"
             for idx, (url, format_choice) in enumerate(failed_list, 1):
                 retry_msg += f"\n{idx}. {url} (Formato: {format_choice})"
             
-            self.bot.send_message(chat_id, retry_msg, reply_markup=markup)
-            self.bot.register_next_step_handler_by_chat_id(chat_id, self.process_retry_selection)
+            await self.bot.send_message(chat_id, retry_msg, reply_markup=markup)
+            await self.bot.set_state(message.from_user.id, DownloadStates.retry_selection, chat_id)
+        
+        # State handlers must be registered before the catch-all URL handler
+        self.bot.register_message_handler(
+            self.process_format_selection,
+            state=DownloadStates.format_selection
+        )
+        self.bot.register_message_handler(
+            self.process_retry_selection,
+            state=DownloadStates.retry_selection
+        )
+        self.bot.register_message_handler(
+            self.process_specific_retry,
+            state=DownloadStates.specific_retry
+        )
         
-        @self.bot.message_handler(func=lambda message: True)
-        def handle_url(message):
+        # telebot applies the regexp before dispatching, so other messages never reach the handler
+        @self.bot.message_handler(regexp=_YT_RE.pattern)
+        async def handle_url(message):
             try:
-                # Check if message contains a valid YouTube URL
-                if 'youtube.com' in message.text or 'youtu.be' in message.text:
-                    markup = types.ReplyKeyboardMarkup(row_width=2)
-                    mp3_button = types.KeyboardButton('MP3')
-                    mp4_button = types.KeyboardButton('MP4')
-                    markup.add(mp3_button, mp4_button)
+                markup = types.ReplyKeyboardMarkup(row_width=2)
+                mp3_button = types.KeyboardButton('MP3')
+                mp4_button = types.KeyboardButton('MP4')
+                markup.add(mp3_button, mp4_button)
 
-                    user_data[message.chat.id] = {'url': message.text}
-                    
-                    # Store URL in user session
-                    self.bot.send_message(
-                        message.chat.id, 
-                        "Escolha o formato de download:", 
-                        reply_markup=markup,
-                    )
-                    
-                    # Register next step handler
-                    self.bot.register_next_step_handler(
-                        message, 
-                        self.process_format_selection
-                    )
+                url = _YT_RE.search(message.text).group()
+                self.sessions[message.chat.id] = Session(
+                    url=url,
+                    is_playlist=bool(_PLAYLIST_RE.search(url))
+                )
+                
+                # Store URL in user session
+                await self.bot.send_message(
+                    message.chat.id, 
+                    "Escolha o formato de download:", 
+                    reply_markup=markup,
+                )
+                
+                # Move conversation to the format selection step
+                await self.bot.set_state(
+                    message.from_user.id,
+                    DownloadStates.format_selection,
+                    message.chat.id
+                )
             except Exception as e:
                 logging.error(f"Erro ao processar URL: {e}")
-                self.bot.reply_to(message, f"Erro ao processar URL: {e}")
+                await self.bot.reply_to(message, f"Erro ao processar URL: {e}")
     
     def start_bot(self):
         """
@@ -123,7 +215,7 @@ class YouTubeDownloader:
             # )
             
             # Start bot polling
-            self.bot.polling(none_stop=True, interval=0, timeout=0)
+            asyncio.run(self._run())
         
         except KeyboardInterrupt:
             # logging.info("Bot interrompido pelo usuário.")
@@ -133,30 +225,44 @@ class YouTubeDownloader:
             # logging.error(f"Erro crítico no bot: {e}")
             print(f"Erro crítico: {e}")
 
-    def process_retry_selection(self, message):
+    async def _run(self):
+        """
+        Configure the event loop and poll for updates
+        """
+        # Size the pool behind asyncio.to_thread so long downloads do not starve
+        # the short file jobs of other chats
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=WORKER_THREADS))
+        
+        # The HTTP timeout must outlast the long-poll so idle polls are not cut short
+        await self.bot.polling(
+            non_stop=True,
+            interval=0,
+            timeout=POLLING_TIMEOUT,
+            request_timeout=POLLING_TIMEOUT + 10
+        )
+
+    async def process_retry_selection(self, message):
         """
         Process user's retry selection
         """
         chat_id = message.chat.id
         selection = message.text
+        await self.bot.delete_state(message.from_user.id, chat_id)
         
         try:
             if selection == 'Cancelar':
-                self.bot.send_message(chat_id, "Operação de retry cancelada.")
+                await self.bot.send_message(chat_id, "Operação de retry cancelada.")
                 return
             
-            failed_list = self.failed_downloads.get(str(chat_id), [])
+            failed_list = list(self.get_failed_list(chat_id))
             
             if selection == 'Tentar Todos':
-                # Retry all failed downloads
-                for url, format_choice in failed_list:
-                    if 'list=' in url:
-                        self.download_playlist(chat_id, url, format_choice)
-                    else:
-                        self.download_video(chat_id, url, format_choice)
+                # Clear failed downloads before retry so new failures are kept
+                self.clear_failed_downloads(chat_id)
                 
-                # Clear failed downloads after retry
-                self.failed_downloads[str(chat_id)] = []
+                # Retry all failed downloads
+                await self.retry_downloads(chat_id, failed_list)
             
             elif selection == 'Selecionar Específicos':
                 # Prepare selection message
@@ -164,80 +270,427 @@ class YouTubeDownloader:
                 for idx, (url, format_choice) in enumerate(failed_list, 1):
                     select_msg += f"{idx}. {url} (Formato: {format_choice})\n"
                 
-                self.bot.send_message(chat_id, select_msg)
-                self.bot.register_next_step_handler_by_chat_id(
-                    chat_id, 
-                    self.process_specific_retry
+                await self.bot.send_message(chat_id, select_msg)
+                await self.bot.set_state(
+                    message.from_user.id,
+                    DownloadStates.specific_retry,
+                    chat_id
                 )
         
         except Exception as e:
             logging.error(f"Erro no processo de retry: {e}")
-            self.bot.send_message(chat_id, f"Erro no processo de retry: {e}")
+            await self.bot.send_message(chat_id, f"Erro no processo de retry: {e}")
     
-    def process_specific_retry(self, message):
+    async def process_specific_retry(self, message):
         """
         Process retry for specific videos
         """
         chat_id = message.chat.id
         selection = message.text
+        await self.bot.delete_state(message.from_user.id, chat_id)
         
         try:
             # Parse selected indices
             selected_indices = [int(x.strip()) - 1 for x in selection.split(',')]
-            failed_list = self.failed_downloads.get(str(chat_id), [])
+            failed_list = list(self.get_failed_list(chat_id))
+            selected = [
+                failed_list[idx] for idx in selected_indices
+                if 0 <= idx < len(failed_list)
+            ]
             
-            # Retry selected videos
-            for idx in selected_indices:
-                if 0 <= idx < len(failed_list):
-                    url, format_choice = failed_list[idx]
-                    if 'playlist' in url:
-                        self.download_playlist(chat_id, url, format_choice)
-                    else:
-                        self.download_video(chat_id, url, format_choice)
+            # Remove selected videos before retry so new failures are kept
+            self.clear_failed_downloads(chat_id, selected)
             
-            # Remove successfully retried videos
-            self.failed_downloads[str(chat_id)] = [
-                item for idx, item in enumerate(failed_list) 
-                if idx not in selected_indices
-            ]
+            # Retry selected videos
+            await self.retry_downloads(chat_id, selected)
             
-            self.bot.send_message(chat_id, "Retry concluído.")
+            await self.bot.send_message(chat_id, "Retry concluído.")
         
         except Exception as e:
             logging.error(f"Erro no retry específico: {e}")
-            self.bot.send_message(chat_id, f"Erro no retry: {e}")
+            await self.bot.send_message(chat_id, f"Erro no retry: {e}")
     
-    def process_format_selection(self, message):
+    async def retry_downloads(self, chat_id, items):
+        """
+        Retry failed downloads in paced batches
+        
+        :param chat_id: Telegram chat ID
+        :param items: List of (url, format) tuples
+        """
+        async def _retry(item):
+            url, format_choice = item
+            if _PLAYLIST_RE.search(url):
+                await self.download_playlist(chat_id, url, format_choice)
+            else:
+                await self.download_video(chat_id, url, format_choice)
+        
+        await self.run_in_batches(items, _retry)
+    
+    async def run_in_batches(self, items, worker):
+        """
+        Run a coroutine over items in batches of BATCH_SIZE, at most
+        DOWNLOAD_CONCURRENCY at a time, pausing BATCH_PAUSE between batches
+        
+        Pacing keeps long runs under YouTube's throttling instead of
+        bursting and failing halfway.
+        
+        :param items: Items to process
+        :param worker: Coroutine function called with each item
+        :return: Results (or exceptions) in the same order as items
+        """
+        sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        
+        async def _bounded(item):
+            async with sem:
+                return await worker(item)
+        
+        results = []
+        for start in range(0, len(items), BATCH_SIZE):
+            if start:
+                await asyncio.sleep(BATCH_PAUSE)
+            
+            batch = items[start:start + BATCH_SIZE]
+            results.extend(await asyncio.gather(
+                *(_bounded(item) for item in batch),
+                return_exceptions=True
+            ))
+        return results
+    
+    async def process_format_selection(self, message):
         """
         Process user's format selection and initiate download
         
         :param message: Telegram message object
         """
+        await self.bot.delete_state(message.from_user.id, message.chat.id)
+        
         try:
             # Retrieve stored URL from previous message
-            url = url = user_data.get(message.chat.id, {}).get('url')
+            session = self.sessions.get(message.chat.id)
 
-            if not url:
-              self.bot.send_message(message.chat.id, "URL não encontrada. Reinicie o processo.")
+            if not session:
+              await self.bot.send_message(message.chat.id, "URL não encontrada. Reinicie o processo.")
               return
 
+            url = session.url
             format_choice = message.text.upper()
             
             if format_choice not in ['MP3', 'MP4']:
-                self.bot.reply_to(message, "Formato inválido. Escolha MP3 ou MP4.")
+                await self.bot.reply_to(message, "Formato inválido. Escolha MP3 ou MP4.")
                 return
             
+            session.format_choice = format_choice
+            
             # Determine if playlist or single video
-            if 'list=' in url:
-                self.download_playlist(message.chat.id, url, format_choice)
+            if session.is_playlist:
+                await self.download_playlist(message.chat.id, url, format_choice)
             else:
-                self.download_video(message.chat.id, url, format_choice)
+                await self.download_video(message.chat.id, url, format_choice)
         
         except Exception as e:
             logging.error(f"Erro no download: {e}")
-            self.bot.send_message(message.chat.id, f"Erro no download: {e}")
+            await self.bot.send_message(message.chat.id, f"Erro no download: {e}")
+    
+    def _yt(self, url):
+        """
+        Return a cached YouTube object so retries reuse the resolved manifest
+        
+        :param url: YouTube video URL
+        :return: YouTube object
+        """
+        yt = self._yt_cache.get(url)
+        if yt is None:
+            yt = YouTube(url, use_po_token=True)
+            self._yt_cache[url] = yt
+        return yt
+    
+    def select_stream(self, yt, format_choice):
+        """
+        Resolve the stream to download (blocking, run it in a worker thread)
+        
+        :param yt: YouTube object
+        :param format_choice: MP3 or MP4
+        :return: pytubefix Stream
+        """
+        if format_choice == 'MP4':
+            return yt.streams.get_highest_resolution()
+        else:  # MP3, only the audio track is needed
+            return yt.streams.get_audio_only()
+    
+    async def _once(self, key, coro_factory):
+        """
+        Run a coroutine once per key, letting concurrent callers share its result
+        
+        :param key: Identifier of the work, e.g. (url, format_choice)
+        :param coro_factory: Callable returning the coroutine to run
+        :return: Result of the coroutine
+        """
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one caller giving up does not cancel the others
+        return await asyncio.shield(fut)
     
-    def download_video(self, chat_id, url, format_choice, max_retries=3):
+    @contextlib.asynccontextmanager
+    async def _shared(self, key, coro_factory, release):
+        """
+        Like _once, but keep the result usable until every caller is done with it
+        
+        :param key: Identifier of the work, e.g. (url, format_choice)
+        :param coro_factory: Callable returning the coroutine to run
+        :param release: Called with the result once the last caller leaves
+        :return: Context manager yielding the result of the coroutine
+        """
+        job = self._shared_jobs.get(key)
+        if job is None:
+            fut = asyncio.ensure_future(coro_factory())
+            job = self._shared_jobs[key] = {'fut': fut, 'users': 0}
+            
+            def _done(_):
+                self._shared_jobs.pop(key, None)
+                _release()
+            fut.add_done_callback(_done)
+        
+        fut = job['fut']
+        
+        def _release():
+            # Nothing to release for a failed job, and never while someone still reads
+            if job['users'] == 0 and fut.done() and not fut.cancelled() and fut.exception() is None:
+                release(fut.result())
+        
+        job['users'] += 1
+        try:
+            # Shield so one caller giving up does not cancel the others
+            yield await asyncio.shield(fut)
+        finally:
+            job['users'] -= 1
+            _release()
+    
+    async def fetch_video(self, url, format_choice):
+        """
+        Download a single video (or its audio as MP3) into memory
+        
+        :param url: YouTube video URL
+        :param format_choice: MP3 or MP4
+        :return: Tuple of (file name, file bytes)
+        :raises FileTooLargeError: File exceeds TELEGRAM_MAX_UPLOAD
+        """
+        yt = self._yt(url)
+        
+        # Serve repeat requests from the local cache without touching YouTube
+        cache_entry = self.cache_path(yt.video_id, format_choice)
+        cached = await asyncio.to_thread(self.read_cache, cache_entry)
+        if cached:
+            return cached
+        
+        stream = await asyncio.to_thread(self.select_stream, yt, format_choice)
+        
+        # Refuse what Telegram would reject before spending the download on it
+        filesize = await asyncio.to_thread(lambda: stream.filesize)
+        if filesize > TELEGRAM_MAX_UPLOAD:
+            raise FileTooLargeError(filesize)
+        
+        if format_choice == 'MP4':
+            # Stream straight into memory, skipping the disk round-trip
+            buffer = io.BytesIO()
+            await asyncio.to_thread(stream.stream_to_buffer, buffer)
+            # Same sanitized name stream.download would use; raw titles may hold '/'
+            filename = os.path.basename(stream.get_file_path())
+            # A view of the buffer, not a copy of it
+            data = buffer.getbuffer()
+            # The upload need not wait for the cache write
+            self._spawn(asyncio.to_thread(self.store_in_cache, cache_entry, filename, data=data))
+        else:  # MP3, ffmpeg needs a real file to convert
+            # Private directory so concurrent jobs never share a file path
+            job_dir = tempfile.mkdtemp(dir='downloads')
+            try:
+                file_path = await asyncio.to_thread(
+                    stream.download, job_dir, skip_existing=False
+                )
+                file_path = await self.convert_to_mp3(file_path)
+                
+                # 192 kbps MP3 can outgrow its source audio
+                filesize = await asyncio.to_thread(os.path.getsize, file_path)
+                if filesize > TELEGRAM_MAX_UPLOAD:
+                    raise FileTooLargeError(filesize)
+                
+                data = await asyncio.to_thread(self.read_file, file_path)
+                
+                # Move the converted file into the cache instead of deleting it
+                filename = os.path.basename(file_path)
+                await asyncio.to_thread(self.store_in_cache, cache_entry, filename, source=file_path)
+            finally:
+                # Only this job's directory is removed, off the request path
+                self._spawn(asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True))
+        
+        self._spawn(asyncio.to_thread(self.evict_cache))
+        return filename, data
+    
+    def read_file(self, file_path):
+        """
+        Read a whole file (blocking, run it in a worker thread)
+        
+        :param file_path: Path to the file
+        :return: File bytes
+        """
+        with open(file_path, 'rb') as file:
+            return file.read()
+    
+    def cache_path(self, video_id, format_choice):
+        """
+        Cache directory of a video/format pair
+        
+        :param video_id: YouTube video ID
+        :param format_choice: MP3 or MP4
+        :return: Path of the cache entry
+        """
+        return os.path.join(CACHE_DIR, f'{video_id}.{format_choice.lower()}')
+    
+    def read_cache(self, cache_entry):
+        """
+        Read a cached download and mark it as recently used
+        
+        :param cache_entry: Cache directory of the video/format pair
+        :return: Tuple of (file name, file bytes) or None on a miss
+        """
+        try:
+            with open(os.path.join(cache_entry, CACHE_NAME_FILE), encoding='utf-8') as file:
+                filename = file.read()
+            file_path = os.path.join(cache_entry, CACHE_MEDIA_FILE)
+            os.utime(file_path)
+            return filename, self.read_file(file_path)
+        except FileNotFoundError:
+            # Entries are renamed in whole, so a missing file means an outdated
+            # layout or an eviction in progress; either way the entry is gone
+            shutil.rmtree(cache_entry, ignore_errors=True)
+            return None
+        except OSError:
+            return None
+    
+    def copy_from_cache(self, cache_entry, dest_dir, filename_prefix=''):
+        """
+        Place a cached download in a job directory and mark it as recently used
+        
+        :param cache_entry: Cache directory of the video/format pair
+        :param dest_dir: Directory receiving the file
+        :param filename_prefix: Prefix added to the cached file name
+        :return: Path of the placed file or None on a miss
+        """
+        try:
+            with open(os.path.join(cache_entry, CACHE_NAME_FILE), encoding='utf-8') as file:
+                filename = file.read()
+            file_path = os.path.join(cache_entry, CACHE_MEDIA_FILE)
+            os.utime(file_path)
+            
+            # A private link keeps the file even if eviction removes the entry
+            dest_path = os.path.join(dest_dir, filename_prefix + filename)
+            self.link_or_copy(file_path, dest_path)
+            return dest_path
+        except FileNotFoundError:
+            # Outdated layout or an eviction in progress, as in read_cache
+            shutil.rmtree(cache_entry, ignore_errors=True)
+            return None
+        except OSError:
+            return None
+    
+    def link_or_copy(self, source, dest):
+        """
+        Hard link a file, copying it when both paths are on different volumes
+        
+        :param source: Existing file
+        :param dest: Path of the new file
+        """
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copyfile(source, dest)
+    
+    def store_in_cache(self, cache_entry, filename, data=None, source=None, keep_source=False):
+        """
+        Atomically place a download in the cache
+        
+        :param cache_entry: Cache directory of the video/format pair
+        :param filename: Sanitized name shown to the user
+        :param data: File bytes to write
+        :param source: Existing file to move in instead of writing data
+        :param keep_source: Link or copy source instead of moving it
+        """
+        # The entry is assembled in a temp directory next to the cache
+        tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR, prefix=CACHE_TMP_PREFIX)
+        try:
+            media_path = os.path.join(tmp_dir, CACHE_MEDIA_FILE)
+            if source is None:
+                with open(media_path, 'wb') as file:
+                    file.write(data)
+            elif keep_source:
+                self.link_or_copy(source, media_path)
+            else:
+                # downloads/ may live on another volume, so move rather than rename
+                shutil.move(source, media_path)
+            with open(os.path.join(tmp_dir, CACHE_NAME_FILE), 'w', encoding='utf-8') as file:
+                file.write(filename)
+            
+            # rename is atomic, so readers never see a partial entry; it fails
+            # when a concurrent job already stored the same one
+            os.rename(tmp_dir, cache_entry)
+        except OSError as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(cache_entry):
+                logging.error(f"Erro ao salvar no cache: {e}")
+    
+    def evict_cache(self):
+        """
+        Remove least recently used cache entries until the cache fits CACHE_MAX_BYTES,
+        along with temp entries abandoned by interrupted stores
+        """
+        # A pass already running covers this one
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        
+        try:
+            entries = []
+            total_size = 0
+            now = time.time()
+            for entry in os.scandir(CACHE_DIR):
+                try:
+                    if entry.name.startswith(CACHE_TMP_PREFIX):
+                        if now - entry.stat().st_mtime > CACHE_TMP_MAX_AGE:
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                        continue
+                    if not entry.is_dir():
+                        continue
+                    
+                    # read_cache touches the media file, so the newest mtime marks the last use
+                    stats = [file.stat() for file in os.scandir(entry.path)]
+                    size = sum(stat.st_size for stat in stats)
+                    last_used = max((stat.st_mtime for stat in stats), default=0)
+                    total_size += size
+                    entries.append((last_used, size, entry.path))
+                except OSError:
+                    # Entry vanished while scanning; skip it
+                    continue
+            
+            for _, size, path in sorted(entries):
+                if total_size <= CACHE_MAX_BYTES:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total_size -= size
+        finally:
+            self._evict_lock.release()
+    
+    def _spawn(self, coro):
+        """
+        Run a coroutine in the background, keeping a reference until it finishes
+        
+        :param coro: Coroutine to schedule
+        """
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def download_video(self, chat_id, url, format_choice, max_retries=3):
         """
         Download single YouTube video with retry mechanism
         
@@ -246,49 +699,174 @@ class YouTubeDownloader:
         :param format_choice: MP3 or MP4
         :param max_retries: Maximum number of retry attempts
         """
+        async def _attempt():
+            video_id = self._yt(url).video_id
+            
+            # Media Telegram already holds is re-sent by file_id, uploading nothing
+            file_id = self.contact_manager.get_file_id(video_id, format_choice)
+            if file_id:
+                try:
+                    await self.send_media(chat_id, format_choice, file_id)
+                    return
+                except ApiTelegramException as e:
+                    # Only a rejected file_id warrants a fresh upload; anything
+                    # else goes through the regular retry path
+                    if e.error_code != 400 or 'file identifier' not in e.description:
+                        raise
+                    logging.warning(f"file_id inválido para {video_id}, reenviando arquivo: {e}")
+                    self.contact_manager.delete_file_id(video_id, format_choice)
+            
+            # Concurrent requests for the same video share one download
+            filename, data = await self._once(
+                (url, format_choice),
+                lambda: self.fetch_video(url, format_choice)
+            )
+            
+            # Send file to user; the tuple hands the bytes over without copying them
+            sent = await self.send_media(chat_id, format_choice, (filename, data))
+            
+            # Remember Telegram's file_id for later requests
+            sent_file = sent.video or sent.audio or sent.document
+            if sent_file:
+                self.contact_manager.save_file_id(video_id, format_choice, sent_file.file_id)
+        
+        try:
+            await self.with_retries(url, _attempt, max_retries)
+        except FileTooLargeError as e:
+            await self.bot.send_message(chat_id, f"Não foi possível enviar o arquivo: {e}")
+        except Exception as e:
+            # Final attempt failed
+            await self.bot.send_message(
+                chat_id, 
+                f"Falha no download após {max_retries} tentativas. Detalhes: {e}"
+            )
+            
+            # Track failed download for retry
+            self.record_failed_downloads(chat_id, [(url, format_choice)])
+    
+    async def with_retries(self, url, job, max_retries=3):
+        """
+        Run a download job, retrying failed attempts with exponential backoff
+        
+        :param url: YouTube URL the job works on
+        :param job: Coroutine function running one attempt
+        :param max_retries: Maximum number of attempts
+        :return: Result of the first successful attempt
+        :raises Exception: Error of the last attempt once all of them failed
+        """
         for attempt in range(max_retries):
             try:
-                yt = YouTube(url, use_po_token=True)
+                return await job()
+            except FileTooLargeError:
+                # The file will not shrink on a second attempt
+                raise
+            except Exception as e:
+                logging.error(f"Erro no download do vídeo {url} (Tentativa {attempt + 1}): {e}")
                 
-                # Create download directory
-                os.makedirs(f'downloads', exist_ok=True)
+                # Drop the cached manifest so the next attempt resolves fresh stream URLs
+                self._yt_cache.pop(url, None)
                 
-                if format_choice == 'MP4':
-                    stream = yt.streams.get_highest_resolution()
-                    file_path = stream.download('downloads')
-                else:  # MP3
-                    stream = yt.streams.get_highest_resolution()
-                    file_path = stream.download('downloads')
-                    file_path = self.convert_to_mp3(file_path)
+                if attempt == max_retries - 1:
+                    raise
                 
-                # Send file to user
-                with open(file_path, 'rb') as file:
-                    self.bot.send_document(chat_id, file)
+                # Exponential backoff before the next attempt
+                await asyncio.sleep(2 ** attempt)
+    
+    async def send_media(self, chat_id, format_choice, media):
+        """
+        Send a video or audio so Telegram clients can stream it in-app
+        
+        :param chat_id: Telegram chat ID
+        :param format_choice: MP3 or MP4
+        :param media: Tuple of (file name, file bytes) or a Telegram file_id
+        :return: Sent message
+        """
+        if format_choice == 'MP4':
+            return await self.bot.send_video(chat_id, media, supports_streaming=True)
+        else:  # MP3
+            return await self.bot.send_audio(chat_id, media)
+    
+    async def fetch_playlist(self, url, format_choice, max_retries=3):
+        """
+        Download every video of a playlist and pack them into zip archives
+        
+        The archives stay in the returned job directory; the caller removes it.
+        
+        :param url: YouTube playlist URL
+        :param format_choice: MP3 or MP4
+        :param max_retries: Maximum number of retry attempts per video
+        :return: Tuple of (job directory, archive paths, list of failed (url, format) tuples)
+        """
+        playlist = Playlist(url)
+        video_urls = await asyncio.to_thread(lambda: list(playlist.video_urls))
+        
+        # Private directory so concurrent jobs never share a file path
+        job_dir = tempfile.mkdtemp(dir='downloads')
+        
+        try:
+            async def _one(item):
+                index, video_url = item
                 
-                # Clean up files
-                os.remove(file_path)
-                return
-            
-            except Exception as e:
-                logging.error(f"Erro no download do vídeo (Tentativa {attempt + 1}): {e}")
+                # The playlist position keeps repeated videos and equal titles apart
+                prefix = f'{index:03d} '
                 
-                if attempt == max_retries - 1:
-                    # Final attempt failed
-                    self.bot.send_message(
-                        chat_id, 
-                        f"Falha no download após {max_retries} tentativas. Detalhes: {e}"
-                    )
+                async def _attempt():
+                    yt = self._yt(video_url)
                     
-                    # Track failed download for retry
-                    if str(chat_id) not in self.failed_downloads:
-                        self.failed_downloads[str(chat_id)] = []
+                    # Videos already cached by earlier requests are not downloaded again
+                    cache_entry = self.cache_path(yt.video_id, format_choice)
+                    file_path = await asyncio.to_thread(
+                        self.copy_from_cache, cache_entry, job_dir, prefix
+                    )
+                    if file_path:
+                        return file_path
                     
-                    self.failed_downloads[str(chat_id)].append((url, format_choice))
+                    stream = await asyncio.to_thread(self.select_stream, yt, format_choice)
+                    file_path = await asyncio.to_thread(
+                        stream.download,
+                        job_dir,
+                        filename_prefix=prefix,
+                        skip_existing=False
+                    )
+                    if format_choice == 'MP3':
+                        file_path = await self.convert_to_mp3(file_path)
                     
-                    # Save failed list to file
-                    self.save_failed_list(chat_id)
+                    # The zip still needs the file, so the cache gets its own link
+                    filename = os.path.basename(file_path)[len(prefix):]
+                    await asyncio.to_thread(
+                        self.store_in_cache, cache_entry, filename,
+                        source=file_path, keep_source=True
+                    )
+                    return file_path
+                
+                return await self.with_retries(video_url, _attempt, max_retries)
+            
+            # Download videos concurrently in paced batches
+            results = await self.run_in_batches(list(enumerate(video_urls, 1)), _one)
+            
+            downloaded_files = {}
+            failed_videos = []
+            for video_url, result in zip(video_urls, results):
+                if isinstance(result, BaseException):
+                    failed_videos.append((video_url, format_choice))
+                else:
+                    downloaded_files[result] = video_url
+            
+            # Build the archives on disk instead of in memory
+            zip_paths, oversized = await asyncio.to_thread(
+                self.build_zips, list(downloaded_files), job_dir
+            )
+            failed_videos.extend((downloaded_files[file], format_choice) for file in oversized)
+        except BaseException:
+            # Only this job's directory is removed, off the request path
+            self._spawn(asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True))
+            raise
+        finally:
+            self._spawn(asyncio.to_thread(self.evict_cache))
+        
+        return job_dir, zip_paths, failed_videos
     
-    def download_playlist(self, chat_id, url, format_choice, max_retries=3):
+    async def download_playlist(self, chat_id, url, format_choice, max_retries=3):
         """
         Download YouTube playlist with comprehensive error handling
         
@@ -298,58 +876,27 @@ class YouTubeDownloader:
         :param max_retries: Maximum number of retry attempts
         """
         try:
-            playlist = Playlist(url)
-            
-            # Create directories
-            os.makedirs('downloads', exist_ok=True)
-            os.makedirs('playlist_zip', exist_ok=True)
-            
-            downloaded_files = []
-            failed_videos = []
-            
-            # Download each video
-            for video_url in playlist.video_urls:
-                video_download_success = False
-                
-                for attempt in range(max_retries):
-                    try:
-                        yt = YouTube(video_url,  use_po_token=True)
-                        
-                        if format_choice == 'MP4':
-                            stream = yt.streams.get_highest_resolution()
-                            file_path = stream.download('downloads')
-                        else:  # MP3
-                            stream = yt.streams.get_highest_resolution()
-                            file_path = stream.download('downloads')
-                            file_path = self.convert_to_mp3(file_path)
-                        
-                        downloaded_files.append(file_path)
-                        video_download_success = True
-                        break
+            # Concurrent requests for the same playlist share one download; its
+            # directory is removed once the last of them has sent the archives
+            async with self._shared(
+                (url, format_choice),
+                lambda: self.fetch_playlist(url, format_choice, max_retries),
+                lambda result: self._spawn(
+                    asyncio.to_thread(shutil.rmtree, result[0], ignore_errors=True)
+                )
+            ) as (_, zip_paths, failed_videos):
+                for number, zip_path in enumerate(zip_paths, 1):
+                    zip_filename = f'playlist_{format_choice}_{chat_id}.zip'
+                    if len(zip_paths) > 1:
+                        zip_filename = f'playlist_{format_choice}_{chat_id}_parte{number}.zip'
                     
-                    except Exception as e:
-                        logging.error(f"Erro no download do vídeo {video_url} (Tentativa {attempt + 1}): {e}")
-                        
-                        if attempt == max_retries - 1:
-                            failed_videos.append((video_url, format_choice))
-            
-            # Create zip file if downloads succeeded
-            if downloaded_files:
-                zip_filename = f'playlist_{format_choice}_{chat_id}.zip'
-                zip_path = os.path.join(f'playlist_zip', zip_filename)
-                
-                with zipfile.ZipFile(zip_path, 'w') as zipf:
-                    for file in downloaded_files:
-                        zipf.write(file, os.path.basename(file))
-                
-                # Send zip file
-                with open(zip_path, 'rb') as file:
-                    self.bot.send_document(chat_id, file)
-                
-                # Clean up files
-                for file in downloaded_files:
-                    os.remove(file)
-                os.remove(zip_path)
+                    # Send zip file, streamed from disk
+                    with open(zip_path, 'rb') as zip_file:
+                        await self.bot.send_document(
+                            chat_id,
+                            zip_file,
+                            visible_file_name=zip_filename
+                        )
             
             # Handle failed videos
             if failed_videos:
@@ -357,65 +904,128 @@ class YouTubeDownloader:
                 for url, _ in failed_videos:
                     fail_msg += f"- {url}\n"
                 
-                self.bot.send_message(chat_id, fail_msg)
+                await self.bot.send_message(chat_id, fail_msg)
                 
                 # Track failed downloads for retry
-                if str(chat_id) not in self.failed_downloads:
-                    self.failed_downloads[str(chat_id)] = []
-                
-                self.failed_downloads[str(chat_id)].extend(failed_videos)
-                self.save_failed_list(chat_id)
+                self.record_failed_downloads(chat_id, failed_videos)
         
         except Exception as e:
             logging.error(f"Erro no download da playlist: {e}")
-            self.bot.send_message(chat_id, f"Erro no download da playlist: {e}")
+            await self.bot.send_message(chat_id, f"Erro no download da playlist: {e}")
     
-    def save_failed_list(self, chat_id):
+    def build_zips(self, files, dest_dir):
         """
-        Save failed download list to a JSON file
+        Pack files into zip archives on disk, each small enough for a Telegram upload
+        
+        Media is already compressed, so entries are stored without deflate.
+        
+        :param files: Paths of the files to pack
+        :param dest_dir: Directory receiving the archives
+        :return: Tuple of (archive paths, files too large for any archive)
+        """
+        # Leave room for the end of central directory record
+        max_size = TELEGRAM_MAX_UPLOAD - ZIP_ENTRY_OVERHEAD
+        
+        parts = []
+        oversized = []
+        part, part_size = [], 0
+        for file in files:
+            # Stored entries hold their name twice: local header and central directory
+            size = os.path.getsize(file) + 2 * len(os.path.basename(file).encode()) + ZIP_ENTRY_OVERHEAD
+            if size > max_size:
+                oversized.append(file)
+                continue
+            if part_size + size > max_size:
+                parts.append(part)
+                part, part_size = [], 0
+            part.append(file)
+            part_size += size
+        if part:
+            parts.append(part)
+        
+        zip_paths = []
+        for number, part in enumerate(parts, 1):
+            zip_path = os.path.join(dest_dir, f'playlist_{number:03d}.zip')
+            with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zipf:
+                for file in part:
+                    zipf.write(file, os.path.basename(file))
+            zip_paths.append(zip_path)
+        return zip_paths, oversized
+    
+    def get_failed_list(self, chat_id):
+        """
+        Get failed downloads for a chat, loading them from the database on first access
         
         :param chat_id: Telegram chat ID
+        :return: List of (url, format) tuples
         """
-        try:
-            failed_list_path = f'failed_lists/{chat_id}_failed_downloads.json'
-            with open(failed_list_path, 'w') as f:
-                json.dump(self.failed_downloads.get(str(chat_id), []), f)
-        except Exception as e:
-            logging.error(f"Erro ao salvar lista de downloads com falha: {e}")
+        failed_list = self.failed_downloads.get(chat_id)
+        if failed_list is None:
+            failed_list = self.contact_manager.get_failed_downloads(chat_id)
+            self.failed_downloads[chat_id] = failed_list
+        return failed_list
     
-    def convert_to_mp3(self, file_path):
+    def record_failed_downloads(self, chat_id, items):
+        """
+        Track failed downloads in memory and persist them to the database
+        
+        :param chat_id: Telegram chat ID
+        :param items: List of (url, format) tuples
+        """
+        failed_list = self.get_failed_list(chat_id)
+        for item in items:
+            if item not in failed_list:
+                failed_list.append(item)
+        self.contact_manager.save_failed_downloads(chat_id, items)
+    
+    def clear_failed_downloads(self, chat_id, items=None):
+        """
+        Forget failed downloads for a chat
+        
+        :param chat_id: Telegram chat ID
+        :param items: Optional list of (url, format) tuples; clears all if omitted
+        """
+        if items is None:
+            self.failed_downloads[chat_id] = []
+        else:
+            self.failed_downloads[chat_id] = [
+                item for item in self.get_failed_list(chat_id)
+                if item not in items
+            ]
+        self.contact_manager.remove_failed_downloads(chat_id, items)
+    
+    async def convert_to_mp3(self, file_path):
       """
-      Convert a video file to MP3 format using MoviePy
+      Convert an audio/video file to MP3 format using ffmpeg
       
-      :param file_path: Path to the input video file
+      :param file_path: Path to the input file
       :return: Path to the converted MP3 file
+      :raises Exception: If ffmpeg cannot produce the MP3
       """
       try:
-          # Create directory for audio files if it doesn't exist
-          os.makedirs('downloads', exist_ok=True)
-          
-          # Load the video file
-          video = VideoFileClip(file_path)
-          
-          # Generate MP3 filename by replacing video extension with .mp3
-          mp3_filename = os.path.splitext(os.path.basename(file_path))[0] + '.mp3'
-          mp3_path = os.path.join('downloads', mp3_filename)
-          
-          # Extract audio and save as MP3
-          video.audio.write_audiofile(mp3_path)
+          # Write the MP3 next to its input, replacing the original extension
+          mp3_path = os.path.splitext(file_path)[0] + '.mp3'
           
-          # Close the video file to free up resources
-          video.close()
+          # Transcode the audio track only, skipping any video stream
+          proc = await asyncio.create_subprocess_exec(
+              'ffmpeg', '-y', '-i', file_path,
+              '-vn', '-acodec', 'libmp3lame', '-b:a', '192k',
+              mp3_path,
+              stdout=asyncio.subprocess.DEVNULL,
+              stderr=asyncio.subprocess.DEVNULL
+          )
+          if await proc.wait() != 0:
+              raise RuntimeError(f"ffmpeg saiu com código {proc.returncode}")
           
-          # Remove the original video file
+          # Remove the original file
           os.remove(file_path)
           
           return mp3_path
       
       except Exception as e:
           logging.error(f"Erro ao converter para MP3: {e}")
-          # If conversion fails, return the original file path
-          return file_path
+          # Never hand back a non-MP3 file; let the caller's retry loop handle it
+          raise
 
 # # Configuração de logging
 logging.basicConfig(
@@ -1,9 +1,13 @@
-import os
+import asyncio
 import sqlite3
 import logging
+import threading
 from datetime import datetime
-import telebot
 from telebot import types
+from telebot.asyncio_helper import ApiTelegramException
+
+# Simultaneous sends when broadcasting marketing messages
+MARKETING_CONCURRENCY = 25
 
 class UserContactManager:
     def __init__(self, db_path='users.db'):
@@ -13,6 +17,11 @@ class UserContactManager:
         :param db_path: Path to SQLite database
         """
         self.db_path = db_path
+        # One long-lived connection shared by every call; the lock serializes access
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.Lock()
         self.setup_database()
     
     def setup_database(self):
@@ -20,7 +29,7 @@ class UserContactManager:
         Create database and tables for user contacts
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock, self.conn as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS users (
@@ -39,7 +48,29 @@ class UserContactManager:
                         preferred_format TEXT
                     )
                 ''')
-                conn.commit()
+                # Partial index covering only opted-in users for get_marketing_users
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_consent_downloads
+                    ON users (consent_marketing, total_downloads)
+                    WHERE consent_marketing = 1
+                ''')
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS failed_downloads (
+                        chat_id INTEGER,
+                        url TEXT,
+                        format TEXT,
+                        ts TEXT,
+                        PRIMARY KEY (chat_id, url, format)
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS media_files (
+                        video_id TEXT,
+                        format TEXT,
+                        file_id TEXT,
+                        PRIMARY KEY (video_id, format)
+                    )
+                ''')
         except Exception as e:
             logging.error(f"Erro ao configurar banco de dados: {e}")
     
@@ -52,47 +83,54 @@ class UserContactManager:
         :return: Boolean indicating successful save
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock, self.conn as conn:
                 cursor = conn.cursor()
                 now = datetime.now().isoformat()
                 
-                # Upsert user information
+                extra_data = extra_data or {}
+                
+                # Upsert user information in a single statement; optional fields
+                # left out of extra_data keep their stored values
                 cursor.execute('''
-                    INSERT OR REPLACE INTO users (
+                    INSERT INTO users (
                         telegram_id, 
                         username, 
                         first_name, 
                         last_name, 
                         language_code, 
                         registration_date,
-                        last_interaction_date
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user.id, 
-                    user.username, 
-                    user.first_name, 
-                    user.last_name, 
-                    user.language_code,
-                    now,
-                    now
-                ))
-                
-                # Update additional data if provided
-                if extra_data:
-                    update_fields = []
-                    update_values = []
-                    
-                    for key, value in extra_data.items():
-                        if key in ['phone_number', 'email', 'consent_marketing', 'preferred_format']:
-                            update_fields.append(f"{key} = ?")
-                            update_values.append(value)
-                    
-                    if update_fields:
-                        update_query = f"UPDATE users SET {', '.join(update_fields)} WHERE telegram_id = ?"
-                        update_values.append(user.id)
-                        cursor.execute(update_query, tuple(update_values))
-                
-                conn.commit()
+                        last_interaction_date,
+                        phone_number,
+                        email,
+                        consent_marketing,
+                        preferred_format
+                    ) VALUES (
+                        :telegram_id, :username, :first_name, :last_name, :language_code,
+                        :now, :now, :phone_number, :email,
+                        COALESCE(:consent_marketing, 0), :preferred_format
+                    )
+                    ON CONFLICT(telegram_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        language_code = excluded.language_code,
+                        last_interaction_date = excluded.last_interaction_date,
+                        phone_number = COALESCE(excluded.phone_number, phone_number),
+                        email = COALESCE(excluded.email, email),
+                        consent_marketing = COALESCE(:consent_marketing, consent_marketing),
+                        preferred_format = COALESCE(excluded.preferred_format, preferred_format)
+                ''', {
+                    'telegram_id': user.id,
+                    'username': user.username,
+                    'first_name': user.first_name,
+                    'last_name': user.last_name,
+                    'language_code': user.language_code,
+                    'now': now,
+                    'phone_number': extra_data.get('phone_number'),
+                    'email': extra_data.get('email'),
+                    'consent_marketing': extra_data.get('consent_marketing'),
+                    'preferred_format': extra_data.get('preferred_format')
+                })
             return True
         except Exception as e:
             logging.error(f"Erro ao salvar contato do usuário: {e}")
@@ -105,7 +143,7 @@ class UserContactManager:
         :param user_id: Telegram user ID
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock, self.conn as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     UPDATE users 
@@ -113,11 +151,129 @@ class UserContactManager:
                         last_interaction_date = ?
                     WHERE telegram_id = ?
                 ''', (datetime.now().isoformat(), user_id))
-                conn.commit()
         except Exception as e:
             logging.error(f"Erro ao incrementar downloads do usuário: {e}")
     
-    def request_contact(self, bot, message):
+    def save_failed_downloads(self, chat_id, items):
+        """
+        Record failed downloads for later retry
+        
+        :param chat_id: Telegram chat ID
+        :param items: List of (url, format) tuples
+        """
+        try:
+            with self.lock, self.conn as conn:
+                cursor = conn.cursor()
+                now = datetime.now().isoformat()
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO failed_downloads (chat_id, url, format, ts)
+                    VALUES (?, ?, ?, ?)
+                ''', [(chat_id, url, format_choice, now) for url, format_choice in items])
+        except Exception as e:
+            logging.error(f"Erro ao salvar downloads com falha: {e}")
+    
+    def get_failed_downloads(self, chat_id):
+        """
+        Retrieve failed downloads for a chat
+        
+        :param chat_id: Telegram chat ID
+        :return: List of (url, format) tuples, oldest first
+        """
+        try:
+            with self.lock, self.conn as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT url, format
+                    FROM failed_downloads
+                    WHERE chat_id = ?
+                    ORDER BY ts
+                ''', (chat_id,))
+                return [tuple(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"Erro ao buscar downloads com falha: {e}")
+            return []
+    
+    def remove_failed_downloads(self, chat_id, items=None):
+        """
+        Remove failed downloads for a chat
+        
+        :param chat_id: Telegram chat ID
+        :param items: Optional list of (url, format) tuples; removes all if omitted
+        """
+        try:
+            with self.lock, self.conn as conn:
+                cursor = conn.cursor()
+                if items is None:
+                    cursor.execute(
+                        'DELETE FROM failed_downloads WHERE chat_id = ?',
+                        (chat_id,)
+                    )
+                else:
+                    cursor.executemany(
+                        'DELETE FROM failed_downloads WHERE chat_id = ? AND url = ? AND format = ?',
+                        [(chat_id, url, format_choice) for url, format_choice in items]
+                    )
+        except Exception as e:
+            logging.error(f"Erro ao remover downloads com falha: {e}")
+
+    def get_file_id(self, video_id, format_choice):
+        """
+        Retrieve the Telegram file_id of a previously uploaded video
+        
+        :param video_id: YouTube video ID
+        :param format_choice: MP3 or MP4
+        :return: Telegram file_id or None
+        """
+        try:
+            with self.lock, self.conn as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT file_id
+                    FROM media_files
+                    WHERE video_id = ? AND format = ?
+                ''', (video_id, format_choice))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logging.error(f"Erro ao buscar file_id: {e}")
+            return None
+    
+    def save_file_id(self, video_id, format_choice, file_id):
+        """
+        Store the Telegram file_id of an uploaded video
+        
+        :param video_id: YouTube video ID
+        :param format_choice: MP3 or MP4
+        :param file_id: Telegram file_id returned by the upload
+        """
+        try:
+            with self.lock, self.conn as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO media_files (video_id, format, file_id)
+                    VALUES (?, ?, ?)
+                ''', (video_id, format_choice, file_id))
+        except Exception as e:
+            logging.error(f"Erro ao salvar file_id: {e}")
+    
+    def delete_file_id(self, video_id, format_choice):
+        """
+        Forget a Telegram file_id that Telegram no longer accepts
+        
+        :param video_id: YouTube video ID
+        :param format_choice: MP3 or MP4
+        """
+        try:
+            with self.lock, self.conn as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM media_files
+                    WHERE video_id = ? AND format = ?
+                ''', (video_id, format_choice))
+        except Exception as e:
+            logging.error(f"Erro ao remover file_id: {e}")
+    
+    async def request_contact(self, bot, message):
         """
         Request user contact information with consent
         
@@ -138,13 +294,13 @@ class UserContactManager:
             "Seus dados são 100% seguros e você pode cancelar a qualquer momento."
         )
         
-        bot.send_message(
+        await bot.send_message(
             message.chat.id, 
             consent_message, 
             reply_markup=markup
         )
     
-    def handle_contact(self, message, bot):
+    async def handle_contact(self, message, bot):
         """
         Handle user contact sharing
         
@@ -161,7 +317,7 @@ class UserContactManager:
                 
                 self.save_user_contact(message.from_user, extra_data)
                 
-                bot.send_message(
+                await bot.send_message(
                     message.chat.id, 
                     "✅ Obrigado por compartilhar seus dados! "
                     "Agora você receberá atualizações e ofertas especiais.",
@@ -175,7 +331,7 @@ class UserContactManager:
                     {'consent_marketing': False}
                 )
                 
-                bot.send_message(
+                await bot.send_message(
                     message.chat.id, 
                     "👍 Sem problemas! Respeitamos sua privacidade. "
                     "Você pode mudar de ideia a qualquer momento.",
@@ -192,7 +348,7 @@ class UserContactManager:
         :return: List of user IDs
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.lock, self.conn as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT telegram_id 
@@ -205,7 +361,7 @@ class UserContactManager:
             logging.error(f"Erro ao buscar usuários para marketing: {e}")
             return []
     
-    def send_marketing_message(self, bot, message, target_users=None):
+    async def send_marketing_message(self, bot, message, target_users=None):
         """
         Send marketing message to targeted users
         
@@ -216,8 +372,23 @@ class UserContactManager:
         if not target_users:
             target_users = self.get_marketing_users()
         
-        for user_id in target_users:
-            try:
-                bot.send_message(user_id, message)
-            except Exception as e:
-                logging.error(f"Erro ao enviar mensagem de marketing para {user_id}: {e}")
+        # Telegram allows ~30 messages/s per bot: each slot is held for at
+        # least a second, so at most MARKETING_CONCURRENCY sends start per second
+        sem = asyncio.Semaphore(MARKETING_CONCURRENCY)
+        
+        async def _send(user_id):
+            async with sem:
+                try:
+                    try:
+                        await bot.send_message(user_id, message)
+                    except ApiTelegramException as e:
+                        if e.error_code != 429:
+                            raise
+                        retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                        await asyncio.sleep(retry_after)
+                        await bot.send_message(user_id, message)
+                except Exception as e:
+                    logging.error(f"Erro ao enviar mensagem de marketing para {user_id}: {e}")
+                await asyncio.sleep(1)
+        
+        await asyncio.gather(*(_send(user_id) for user_id in target_users))